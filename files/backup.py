@@ -14,13 +14,15 @@ This script is compatible with Python 2.7 and Python 3.5+
 from __future__ import print_function
 
 import argparse
-import bisect
-import datetime
 import errno
+import fcntl
+import fnmatch
 import logging
 import os
-import re
 import shlex
+import shutil
+import signal
+import stat
 import subprocess
 import sys
 import time
@@ -30,6 +32,16 @@ try:
 except ImportError:
     from pipes import quote as shlex_quote
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 try:
     import psycopg2
 except ImportError:
@@ -51,35 +63,15 @@ RSYNC_EXCLUDES = (
     'pg_tmp*',
     'pg_internal.init',
 )
-BACKUP_LABEL_RE = re.compile(r"\d{8}T\d{6}Z")
-LAST_SEGMENT_RE = re.compile(r"START WAL LOCATION:.*\(file ([^)]+)\)")
-
-log = None
-
-
-class Label(object):
-    # for sorting
-    def __init__(self, label):
-        self.label = label
-        self.date, self.time = [int(x) for x in label.rstrip('Z').split('T')]
-
-    def __str__(self):
-        return self.label
-
-    def __eq__(self, other):
-        return self.date == other.date and self.time == other.time
+RSYNC_EXCLUDE_ARGS = tuple(arg for exclude in RSYNC_EXCLUDES for arg in ('--exclude', exclude))
+# tablespaces are copied here rather than into pg_tblspc/, since recovery replaces pg_tblspc/<oid> with a symlink
+BACKUP_TABLESPACES_DIR = 'tablespaces'
+RSYNC_SKIP_COMPRESS = ('gz', 'zst', 'xz', 'lz4', 'zip', '7z', 'bz2')
 
-    def __lt__(self, other):
-        return self.date <= other.date and self.time < other.time
+# Python ignores these, subprocess restores their default handlers in children so spawn() must as well
+SPAWN_DEFAULT_SIGNALS = tuple(getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ') if hasattr(signal, name))
 
-    def __le__(self, other):
-        return self.date <= other.date and self.time <= other.time
-
-    def __gt__(self, other):
-        return self.date >= other.date and self.time > other.time
-
-    def __ge__(self, other):
-        return self.date >= other.date and self.time >= other.time
+log = None
 
 
 class State(object):
@@ -87,11 +79,29 @@ class State(object):
         self._conn = None
         self._cursor = None
         self._label = None
-        self._rsync_opts = None
+        self._rsync_opts = ()
         self._pg_major_version = None
+        self._ssh_control_path = None
+        self._rsync_argv = ('rsync',)
+
+    def _set_rsync_argv(self):
+        # the rsync command prefix only changes when these are set, so build it once here
+        argv = ('rsync',) + self._rsync_opts
+        if self._ssh_control_path:
+            argv += ('-e', 'ssh -o ControlPath=' + shlex_quote(self._ssh_control_path))
+        self._rsync_argv = argv
 
     def set_rsync_opts(self, opts):
-        self._rsync_opts = opts
+        self._rsync_opts = tuple(shlex.split(opts)) if opts else ()
+        self._set_rsync_argv()
+
+    def set_ssh_control_path(self, control_path):
+        self._ssh_control_path = control_path
+        self._set_rsync_argv()
+
+    @property
+    def ssh_control_path(self):
+        return self._ssh_control_path
 
     @property
     def pg_major_version(self):
@@ -110,16 +120,21 @@ class State(object):
 
     @property
     def rsync_cmd(self):
-        cmd = ['rsync']
-        if self._rsync_opts:
-            cmd.extend(shlex.split(self._rsync_opts))
-        return cmd
+        return list(self._rsync_argv)
+
+    @property
+    def rsync_bulk_cmd(self):
+        # for data transfers, which should each get their own ssh connection rather than share the control master's
+        return ['rsync'] + list(self._rsync_opts)
 
     @property
     def conn(self):
         if not self._conn:
             log.info('Connecting to database')
             self._conn = psycopg2.connect('dbname=postgres')
+            # ensure the connection is not inherited by subprocesses, which are then spawned without closing fds
+            fd = self._conn.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
         return self._conn
 
     @property
@@ -131,7 +146,7 @@ class State(object):
     @property
     def label(self):
         if not self._label:
-            self._label = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+            self._label = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
             log.info('Backup label is: %s', self._label)
         return self._label
 
@@ -145,7 +160,8 @@ def parse_args(argv):
     parser.add_argument('--keep', type=int, default=-1, help='Keep this many backups (default: all)')
     parser.add_argument('--clean-archive', action='store_true', default=False, help='Clean WAL archive')
     parser.add_argument('--rsync-connect-opts', default=None, help='Options to always pass to rsync (e.g. for connection parameters)')
-    parser.add_argument('--rsync-backup-opts', default='-rptg', help='Options to pass to rsync for backup (default: -rptg)')
+    parser.add_argument('--rsync-backup-opts', default='-rptgW', help='Options to pass to rsync for backup (default: -rptgW)')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of rsync processes to run in parallel for backup (default: 4)')
     parser.add_argument('--pg-bin-dir', default=None, help='Directory containing PostgreSQL auxiliary binaries if not on $PATH')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Verbose output')
     parser.add_argument('backup_path', help='Backup to location (rsync-compatible string)')
@@ -169,6 +185,81 @@ def log_command(cmd):
     log.debug('command is: %s', ' '.join([shlex_quote(x) for x in cmd]))
 
 
+def spawn(cmd):
+    # posix_spawn does not copy the parent's page tables like fork does, use it where available (Python 3.8+)
+    if not hasattr(os, 'posix_spawnp'):
+        subprocess.check_call(cmd, close_fds=False)
+        return
+    pid = os.posix_spawnp(cmd[0], cmd, os.environ, setsigdef=SPAWN_DEFAULT_SIGNALS)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def call_in_background(func, *args):
+    """Start calling func in a thread, returns a function that waits for and returns the result of the call"""
+    if ThreadPoolExecutor is None:
+        result = func(*args)
+        return lambda: result
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(func, *args)
+    executor.shutdown(wait=False)
+    return future.result
+
+
+def get_remote_host(backup_path):
+    # rsync daemon paths (host::module, rsync://) do not use ssh
+    if backup_path.startswith('rsync://'):
+        return None
+    host, sep, path = backup_path.partition(':')
+    if not sep or '/' in host or path.startswith(':'):
+        return None
+    return host
+
+
+def start_ssh_master(backup_path, rsync_connect_opts):
+    host = get_remote_host(backup_path)
+    if not host:
+        return None
+    # can't share the connection if a remote shell is set since I don't want to write a translator from its params
+    # to ssh
+    connect_opts = shlex.split(rsync_connect_opts or '')
+    if 'RSYNC_RSH' in os.environ or any(opt.startswith(('-e', '--rsh')) for opt in connect_opts):
+        log.debug('Remote shell is set, not starting SSH control master')
+        return None
+    # the socket is created in a private dir so that no other user can create it first or connect to it
+    control_dir = tempfile.mkdtemp(prefix='postgresql_backup_ssh_')
+    control_path = os.path.join(control_dir, 'control.sock')
+    cmd = ['ssh', '-M', '-N', '-f', '-o', 'ControlPath=' + control_path, '-o', 'ControlPersist=600', host]
+    log.info('Starting SSH control master for %s', host)
+    log_command(cmd)
+    try:
+        subprocess.check_call(cmd)
+        # ssh exits successfully without multiplexing if it could not create the socket
+        control_stat = os.lstat(control_path)
+        if not stat.S_ISSOCK(control_stat.st_mode) or control_stat.st_uid != os.getuid():
+            raise OSError(errno.EPERM, 'Not a socket owned by this user', control_path)
+    except (OSError, subprocess.CalledProcessError):
+        log.warning('Unable to start SSH control master, rsync will open a new connection for each call')
+        shutil.rmtree(control_dir, ignore_errors=True)
+        return None
+    state.set_ssh_control_path(control_path)
+    return host
+
+
+def stop_ssh_master(host):
+    cmd = ['ssh', '-o', 'ControlPath=' + state.ssh_control_path, '-O', 'exit', host]
+    log_command(cmd)
+    if subprocess.call(cmd) != 0:
+        log.warning('Unable to stop SSH control master, it will exit after its persist timeout')
+    shutil.rmtree(os.path.dirname(state.ssh_control_path), ignore_errors=True)
+    state.set_ssh_control_path(None)
+
+
 def initiate_backup():
     log.info("Initiating backup with pg_start_backup()")
     if state.pg_major_version < 15:
@@ -178,40 +269,235 @@ def initiate_backup():
     state.cursor.execute(start_backup_sql, {'label': state.label})
 
 
-def perform_backup(backup_path, rsync_backup_opts):
+def list_backup_subtrees(data_dir):
+    """Return the top-level data directories and tablespaces that can be copied in parallel"""
+    subdirs = []
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        # the contents of these are excluded entirely, and tablespaces are handled below
+        if name == 'pg_tblspc' or name + '/*' in RSYNC_EXCLUDES:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            subdirs.append(name)
+    tablespaces = []
+    tblspc_dir = os.path.join(data_dir, 'pg_tblspc')
+    if os.path.isdir(tblspc_dir):
+        for oid in sorted(os.listdir(tblspc_dir)):
+            path = os.path.join(tblspc_dir, oid)
+            if os.path.islink(path):
+                tablespaces.append((oid, os.path.realpath(path)))
+    return subdirs, tablespaces
+
+
+def run_rsync(cmd):
+    log_command(cmd)
+    try:
+        spawn(cmd)
+    except subprocess.CalledProcessError as exc:
+        # 24 means some files vanished during the transfer, which is expected when copying a running cluster
+        if exc.returncode != 24:
+            raise
+
+
+def run_rsync_parallel(cmds, jobs):
+    if ThreadPoolExecutor is None or jobs < 2:
+        for cmd in cmds:
+            run_rsync(cmd)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_rsync, cmd) for cmd in cmds]
+        # raises the first exception encountered, in submission order
+        for future in futures:
+            future.result()
+
+
+def find_file(path):
+    for root, dirs, files in os.walk(path):
+        if files:
+            return os.path.join(root, files[0])
+    return None
+
+
+def reflink_supported(src_file, dest_dir):
+    # cloning only works within a copy-on-write filesystem, so try it rather than comparing st_dev, which differs
+    # between btrfs subvolumes that can be cloned across
+    if not src_file:
+        return False
+    probe_path = os.path.join(dest_dir, '.reflink_probe_%d' % os.getpid())
+    cmd = ['cp', '--reflink=always', src_file, probe_path]
+    log_command(cmd)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            returncode = subprocess.call(cmd, stderr=devnull, close_fds=False)
+    except OSError:
+        return False
+    if os.path.exists(probe_path):
+        os.unlink(probe_path)
+    return returncode == 0
+
+
+def reflink_seed_backup(rsync_data_dir, rsync_backup_path, subdirs, tablespaces):
+    # clone the bulk of the data into the backup, rsync then only has to copy what changed during the clone
+    os.makedirs(os.path.join(rsync_backup_path, BACKUP_TABLESPACES_DIR))
+    cmds = []
+    if subdirs:
+        cmds.append(['cp', '-a', '--reflink=always'] + [rsync_data_dir + subdir for subdir in subdirs]
+                    + [rsync_backup_path])
+    for oid, tablespace_dir in tablespaces:
+        if reflink_supported(find_file(tablespace_dir), rsync_backup_path):
+            cmds.append(['cp', '-a', '--reflink=always', tablespace_dir,
+                         os.path.join(rsync_backup_path, BACKUP_TABLESPACES_DIR, oid)])
+    log.info('Cloning data directory to %s with reflinks', rsync_backup_path)
+    for cmd in cmds:
+        log_command(cmd)
+        try:
+            spawn(cmd)
+        except subprocess.CalledProcessError:
+            # most likely files vanished during the copy, which rsync will reconcile
+            log.warning('Reflink copy did not complete successfully, remaining files will be copied by rsync')
+    roots = [os.path.join(rsync_backup_path, subdir) for subdir in subdirs]
+    for oid, _ in tablespaces:
+        # tablespaces contain a PG_<version>_<catversion> dir, which is laid out like base/
+        tablespace_path = os.path.join(rsync_backup_path, BACKUP_TABLESPACES_DIR, oid)
+        if os.path.isdir(tablespace_path):
+            roots.extend(os.path.join(tablespace_path, name) for name in os.listdir(tablespace_path))
+    remove_cloned_excludes(roots)
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def remove_cloned_excludes(roots):
+    # rsync does not delete excluded files, so remove the cloned files it would have skipped. These only appear in the
+    # cloned dirs or one level below them (e.g. base/<oid>/pg_internal.init), so there is no need to walk the whole
+    # tree, and only names without wildcards are checked below the top level to avoid listing the database dirs.
+    exclude_names = [exclude for exclude in RSYNC_EXCLUDES if '/' not in exclude]
+    exclude_literals = [exclude for exclude in exclude_names if not any(c in exclude for c in '*?[')]
+    for root in roots:
+        if not os.path.isdir(root) or os.path.islink(root):
+            continue
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if any(fnmatch.fnmatch(name, exclude) for exclude in exclude_names):
+                remove_path(path)
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                for exclude in exclude_literals:
+                    if os.path.lexists(os.path.join(path, exclude)):
+                        remove_path(os.path.join(path, exclude))
+
+
+def perform_backup(backup_path, rsync_backup_opts, jobs):
     state.cursor.execute("SHOW data_directory")
     data_dir = state.cursor.fetchone()[0]
     rsync_data_dir = data_dir.rstrip('/') + os.sep
     rsync_backup_path = os.path.join(backup_path, state.label)
 
+    # hardlink files unchanged since the most recent backup rather than copying them again, the path is relative to the
+    # destination directory so it works for both local and remote backup paths
+    try:
+        labels = get_current_labels(backup_path)
+    except subprocess.CalledProcessError:
+        log.warning('Unable to list existing backups in %s, performing full copy', backup_path)
+        labels = []
+    prev_label = labels[-1] if labels else None
+    if prev_label:
+        log.info('Unchanged files will be hardlinked from previous backup: %s', prev_label)
+
     # assemble rsync command line
-    cmd = state.rsync_cmd
-    cmd.extend(shlex.split(rsync_backup_opts))
-    cmd.extend(['--delete', '--delete-delay'])
-    [cmd.extend(['--exclude', exclude]) for exclude in RSYNC_EXCLUDES]
+    base_cmd = state.rsync_bulk_cmd
+    if ':' in backup_path:
+        # transfers to remote paths are typically network bound, and data pages compress well. rsync 3.2+ negotiates
+        # the best algorithm both sides support. These come before the backup opts so that they can be overridden with
+        # --no-compress --compress-level=0.
+        base_cmd.extend(['-z', '--compress-level=3', '--skip-compress=' + '/'.join(RSYNC_SKIP_COMPRESS)])
+    base_cmd.extend(shlex.split(rsync_backup_opts))
+    base_cmd.extend(['--delete', '--delete-delay'])
+    base_cmd.extend(RSYNC_EXCLUDE_ARGS)
+
+    def link_dest(*path):
+        if prev_label:
+            # the quick check compares mtimes in whole seconds by default, so a file written again within the same
+            # second it was copied into the previous backup would be linked stale, compare nanoseconds (rsync 3.1.3+)
+            return ['--modify-window=-1', '--link-dest=' + os.path.join(*path)]
+        return []
+
+    subdirs, tablespaces = list_backup_subtrees(data_dir)
+    if ':' not in backup_path and reflink_supported(os.path.join(data_dir, 'PG_VERSION'), backup_path):
+        reflink_seed_backup(rsync_data_dir, rsync_backup_path, subdirs, tablespaces)
+
+    # copy everything other than the parallelized subtrees first, this also creates the destination directory
+    cmd = base_cmd + link_dest('..', prev_label)
+    cmd.extend(arg for subdir in subdirs for arg in ('--exclude', '/' + subdir))
+    if tablespaces:
+        cmd.extend(['--exclude', '/pg_tblspc/*', '--exclude', '/' + BACKUP_TABLESPACES_DIR])
     cmd.extend([rsync_data_dir, rsync_backup_path])
-
     log.info('Performing rsync backup from %s to %s', *cmd[-2:])
+    run_rsync(cmd)
+
+    if tablespaces:
+        # rsync only creates the last component of the destination path, so create the tablespaces dir by syncing an
+        # empty dir to it
+        temp_name = tempfile.mkdtemp(prefix="postgresql_backup_empty_")
+        try:
+            cmd = state.rsync_cmd
+            cmd.extend([temp_name + '/', os.path.join(rsync_backup_path, BACKUP_TABLESPACES_DIR)])
+            log_command(cmd)
+            spawn(cmd)
+        finally:
+            os.rmdir(temp_name)
+
+    # then each top-level directory and tablespace with its own rsync
+    cmds = []
+    for subdir in subdirs:
+        cmd = base_cmd + link_dest('..', prev_label)
+        cmd.extend(['--include', '/' + subdir, '--exclude', '/*', rsync_data_dir, rsync_backup_path])
+        cmds.append(cmd)
+    for oid, tablespace_dir in tablespaces:
+        cmd = base_cmd + link_dest('..', '..', '..', prev_label, BACKUP_TABLESPACES_DIR, oid)
+        cmd.extend([tablespace_dir.rstrip('/') + os.sep, os.path.join(rsync_backup_path, BACKUP_TABLESPACES_DIR, oid)])
+        log.info('Tablespace %s will be copied from %s', oid, tablespace_dir)
+        cmds.append(cmd)
+    log.info('Performing rsync backup of %d subdirectories and tablespaces with %d jobs', len(cmds), jobs)
+    run_rsync_parallel(cmds, jobs)
+
+
+def pipe_to_command(cmd, data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
     log_command(cmd)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, close_fds=False)
+    proc.communicate(data)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def write_backup_files(backup_path, files):
+    label_path = os.path.join(backup_path, state.label, '')
+    if ':' not in backup_path:
+        log.info('Writing backup files at path %s: %s', label_path, ', '.join(files))
+        for file_name, file_contents in files.items():
+            mode = 'w' if isinstance(file_contents, str) else 'wb'
+            with open(os.path.join(label_path, file_name), mode) as fh:
+                fh.write(file_contents)
+        return
+    # use a tempdir with rsync since the path is remote, all files are sent with a single call
+    temp_name = tempfile.mkdtemp(prefix='postgresql_backup_')
     try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError as exc:
-        if exc.returncode != 24:
-            raise
-
-
-def write_backup_file(backup_path, file_contents, file_name):
-    file_path = os.path.join(backup_path, state.label, file_name)
-    cmd = state.rsync_cmd
-    # use a tempfile with rsync since the path might be remote
-    mode = 'w' if isinstance(file_contents, str) else 'wb'
-    with tempfile.NamedTemporaryFile(mode=mode, prefix='postgresql_backup_') as fh:
-        fh.write(file_contents)
-        fh.flush()
-        cmd.extend([fh.name, file_path])
-        log.info('Writing backup file at path: %s', file_path)
-        log_command(cmd)
-        subprocess.check_call(cmd)
+        for file_name, file_contents in files.items():
+            mode = 'w' if isinstance(file_contents, str) else 'wb'
+            with open(os.path.join(temp_name, file_name), mode) as fh:
+                fh.write(file_contents)
+        cmd = state.rsync_cmd
+        cmd.extend(['--files-from=-', temp_name + '/', label_path])
+        log.info('Writing backup files at path %s: %s', label_path, ', '.join(files))
+        pipe_to_command(cmd, '\n'.join(files))
+    finally:
+        shutil.rmtree(temp_name)
 
 
 def finalize_backup(backup_path):
@@ -226,44 +512,69 @@ def finalize_backup(backup_path):
     backup_label = row[1]
     tablespace_map = row[2]
     log.info('Last WAL segment for this backup is: %s', last_segment)
-    write_backup_file(backup_path, backup_label, 'backup_label')
+    files = {'backup_label': backup_label}
     if tablespace_map:
-        write_backup_file(backup_path, tablespace_map, 'tablespace_map')
+        files['tablespace_map'] = tablespace_map
+    write_backup_files(backup_path, files)
 
 
-def get_current_labels(backup_path):
+def is_backup_label(entry):
+    # labels are in the format YYYYMMDDTHHMMSSZ
+    return (len(entry) == 16 and entry[8] == 'T' and entry[15] == 'Z'
+            and entry[:8].isdigit() and entry[9:15].isdigit())
+
+
+def iter_labels(backup_path):
     cmd = state.rsync_cmd
     cmd.extend(['--list-only', backup_path.rstrip('/') + '/'])
-    out = subprocess.check_output(cmd)
-    if sys.version_info > (3,):
-        out = out.decode('utf-8')
-    labels = []
-    # there doesn't appear to be a way to format rsync --list-only output
-    for line in out.splitlines():
-        entry = line.split()[-1]
-        if BACKUP_LABEL_RE.match(entry):
-            label = Label(entry)
-            bisect.insort(labels, label)
-    return list(map(str, labels))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=False)
+    completed = False
+    try:
+        # there doesn't appear to be a way to format rsync --list-only output
+        for line in proc.stdout:
+            # decode explicitly rather than with the locale's encoding, which may be ascii under cron
+            fields = line.decode('utf-8', 'replace').split()
+            if fields and is_backup_label(fields[-1]):
+                yield fields[-1]
+        completed = True
+    finally:
+        proc.stdout.close()
+        if not completed:
+            # the caller stopped reading early
+            proc.terminate()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def get_current_labels(backup_path):
+    # sort on YYYYMMDDHHMMSS as an integer
+    labels = [(int(entry[:8] + entry[9:15]), entry) for entry in iter_labels(backup_path)]
+    labels.sort()
+    return [label for _, label in labels]
+
+
+def get_oldest_label(backup_path):
+    # rsync sorts its listing by name, which is chronological for labels, so the first label is the oldest
+    labels = iter_labels(backup_path)
+    try:
+        return next(labels, None)
+    finally:
+        labels.close()
 
 
 def rsync_delete_dirs(backup_path, labels):
     # can't use ssh here since I don't want to write a translator from rsync connect params to ssh
     temp_name = tempfile.mkdtemp(prefix="postgresql_backup_empty_")
     try:
-        # empty the dirs first, unfortunately this has to be done one-by-one
-        for label in labels:
-            cmd = state.rsync_cmd
-            cmd.extend(['-r', '--delete', temp_name + '/', os.path.join(backup_path, label)])
-            log_command(cmd)
-            subprocess.check_call(cmd)
-        # then all the empty dirs can be deleted at once
+        # sync an empty dir over the backup path, only the included dirs and their contents are unprotected from
+        # deletion, so they can all be removed with a single rsync
         cmd = state.rsync_cmd
-        [cmd.extend(['--include', label]) for label in labels]
-        cmd.extend(['--exclude', '*', '-d', '--delete'])
+        cmd.extend(arg for label in labels for arg in ('--include', '/' + label + '/***'))
+        cmd.extend(['--exclude', '*', '-r', '--delete'])
         cmd.extend([temp_name + '/', backup_path])
         log_command(cmd)
-        subprocess.check_call(cmd)
+        spawn(cmd)
     finally:
         os.rmdir(temp_name)
 
@@ -276,25 +587,43 @@ def cleanup_old_backups(backup_path, keep):
         rsync_delete_dirs(backup_path, delete_labels)
 
 
+def read_small_file(path):
+    # backup_label is well under this size, so it can be read in a single call without a file object
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 65536).decode('utf-8', 'replace')
+    finally:
+        os.close(fd)
+
+
 def extract_last_segment_from_backup_label(backup_label):
-    for line in backup_label.splitlines():
-        match = LAST_SEGMENT_RE.match(line)
-        if match:
-            return match.group(1)
-    return None
+    # the line is in the format: START WAL LOCATION: 0/2000028 (file 000000010000000000000002)
+    start = backup_label.find('START WAL LOCATION:')
+    if start < 0:
+        return None
+    end = backup_label.find('\n', start)
+    if end < 0:
+        end = len(backup_label)
+    start = backup_label.find('(file ', start, end)
+    if start < 0:
+        return None
+    start += len('(file ')
+    end = backup_label.find(')', start, end)
+    if end < 0:
+        return None
+    return backup_label[start:end]
 
 
 def cleanup_wal_archive(backup_path, pg_bin_dir):
     assert ':' not in backup_path  # this should be handled by the parser
-    labels = get_current_labels(backup_path)
-    if not labels:
+    oldest_label = get_oldest_label(backup_path)
+    if not oldest_label:
         log.warning("No backups found, cannot clean WAL archive")
         return
-    oldest_label = labels[0]
     backup_label_path = os.path.join(backup_path, oldest_label, 'backup_label')
     try:
-        backup_label = open(backup_label_path).read()
-    except:
+        backup_label = read_small_file(backup_label_path)
+    except OSError:
         log.exception("Cannot read backup_label from oldest backup, WAL archive will not be cleaned")
         return
     last_segment = extract_last_segment_from_backup_label(backup_label)
@@ -311,7 +640,7 @@ def cleanup_wal_archive(backup_path, pg_bin_dir):
     cmd.extend(['-d', wal_archive_path, last_segment])
     log_command(cmd)
     try:
-        subprocess.check_call(cmd)
+        spawn(cmd)
     except OSError as exc:
         if exc.errno == errno.ENOENT:
             log.error("Cannot find pg_archivecleanup (see --pg-bin-dir option)")
@@ -322,17 +651,29 @@ def main(argv):
     args = parse_args(argv)
     configure_logging(args.verbose)
     state.set_rsync_opts(args.rsync_connect_opts)
-    start = time.time()
-    if args.backup:
-        initiate_backup()
-        perform_backup(args.backup_path, args.rsync_backup_opts)
-        finalize_backup(args.backup_path)
-        log.info("Backup complete")
-    if args.keep > 0:
-        cleanup_old_backups(args.backup_path, args.keep)
+    start = monotonic()
+    ssh_master = None
+    if args.backup or args.keep > 0:
+        ssh_master = call_in_background(start_ssh_master, args.backup_path, args.rsync_connect_opts)
+    try:
+        if args.backup:
+            initiate_backup()
+        if ssh_master:
+            # the connection is established while PostgreSQL performs the checkpoint in pg_start_backup()
+            ssh_master()
+        if args.backup:
+            perform_backup(args.backup_path, args.rsync_backup_opts, args.jobs)
+            finalize_backup(args.backup_path)
+            log.info("Backup complete")
+        if args.keep > 0:
+            cleanup_old_backups(args.backup_path, args.keep)
+    finally:
+        ssh_host = ssh_master() if ssh_master else None
+        if ssh_host:
+            stop_ssh_master(ssh_host)
     if args.clean_archive:
         cleanup_wal_archive(args.backup_path, args.pg_bin_dir)
-    elapsed = time.time() - start
+    elapsed = monotonic() - start
     log.info("Completed in %d seconds", elapsed)
 
 
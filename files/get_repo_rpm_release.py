@@ -8,28 +8,61 @@ e.g.:
 
 get_repo_rpm_version.py http://yum.postgresql.org/9.2/redhat/rhel-6-x86_64/ centos
 """
+from __future__ import print_function
 
 import re
 import sys
-import urllib2
+try:
+    from html.parser import HTMLParser
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+except ImportError:
+    from HTMLParser import HTMLParser
+    from urllib2 import HTTPError, urlopen
+
+CHUNK_SIZE = 64 * 1024
+
+
+class RepoLinkParser(HTMLParser):
+    # records the first link matching pattern
+    def __init__(self, pattern):
+        HTMLParser.__init__(self)
+        self.pattern = pattern
+        self.match = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.match is not None or tag != 'a':
+            return
+        for name, value in attrs:
+            if name == 'href' and value and self.pattern.match(value):
+                self.match = value
+                return
+
 
 url, dist = sys.argv[1:]
 
 try:
-    repo = urllib2.urlopen(url)
-except urllib2.HTTPError, e:
-    print >>sys.stderr, "Failed to fetch directory list from %s" % url
+    repo = urlopen(url)
+except HTTPError:
+    print("Failed to fetch directory list from %s" % url, file=sys.stderr)
     raise
 
 pg_version = url.split('/')[3]
 if pg_version[0] == "8" and dist != "sl":
-    re_pattern = 'href=[\'"](pgdg-%s-%s-[\d+].noarch.rpm)[\'"]' % (dist, pg_version)
+    re_pattern = r'pgdg-%s-%s-[\d+].noarch.rpm$' % (dist, pg_version)
 else:
-    re_pattern = 'href=[\'"](pgdg-%s%s-%s-[\d+].noarch.rpm)[\'"]' % (dist, pg_version.replace('.', ''), pg_version)
-match = re.findall(re_pattern, repo.read(), flags=re.I)
+    re_pattern = r'pgdg-%s%s-%s-[\d+].noarch.rpm$' % (dist, pg_version.replace('.', ''), pg_version)
+
+# stop reading the listing as soon as a matching link has been seen
+parser = RepoLinkParser(re.compile(re_pattern, re.I))
+while parser.match is None:
+    chunk = repo.read(CHUNK_SIZE)
+    if not chunk:
+        break
+    parser.feed(chunk.decode('utf-8', 'replace'))
 
-assert match, "No matching %s pgdg repository packages found for version %s at %s" % (dist, pg_version, url)
+assert parser.match, "No matching %s pgdg repository packages found for version %s at %s" % (dist, pg_version, url)
 
-print match[0]
+print(parser.match)
 
 sys.exit(0)